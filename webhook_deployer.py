@@ -1,54 +1,109 @@
+import asyncio
+import atexit
+import binascii
+import contextlib
 import hashlib
 import hmac
+import json
 import os
-import subprocess
+import re
+import sqlite3
 import logging
+import logging.handlers
+import queue
+import threading
+from collections import deque
 from pathlib import Path
+from typing import NoReturn
 from flask import Flask, request, abort, jsonify
 
-# Настройка логирования
+
+# Запуск через `python webhook_deployer.py`: exec gunicorn до любых побочных эффектов
+# импорта ниже (DEPLOY_ROOT, sqlite, потоки логирования и deploy-loop) — их выполнит
+# уже воркер gunicorn
+def _exec_gunicorn() -> NoReturn:
+    """Заменяет текущий процесс на gunicorn с этим приложением."""
+    # Один процесс (-w 1): очередь деплоев и deploy-loop живут в памяти процесса,
+    # параллелизм запросов даёт gthread. При запуске через systemd socket activation
+    # gunicorn сам подхватывает сокет из LISTEN_FDS/LISTEN_PID вместо --bind.
+    user_args = os.environ.get("GUNICORN_CMD_ARGS", "")
+    if "--preload" in user_args:
+        # При --preload импорт выполняется в master до fork, и в воркере
+        # не будет потоков deploy-loop и логирования
+        raise SystemExit("--preload не поддерживается")
+    # Значения по умолчанию идут первыми, чтобы GUNICORN_CMD_ARGS мог их переопределить
+    os.environ["GUNICORN_CMD_ARGS"] = f"--timeout 180 --keep-alive 30 {user_args}"
+    os.execvp(
+        "gunicorn",
+        [
+            "gunicorn",
+            "-k",
+            "gthread",
+            "-w",
+            "1",
+            "--threads",
+            os.environ.get("WEBHOOK_THREADS", "8"),
+            "-b",
+            os.environ.get("WEBHOOK_BIND", "0.0.0.0:8080"),
+            "webhook_deployer:app",
+        ],
+    )
+
+
+if __name__ == "__main__":
+    _exec_gunicorn()
+
+
+# Настройка логирования: запись в stderr идёт в отдельном потоке QueueListener,
+# обработчик запроса только кладёт запись в очередь
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(
+    logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+)
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, _log_handler, respect_handler_level=True
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+# QueueHandler подставляет в запись только текст сообщения (с traceback),
+# итоговый формат задаёт _log_handler
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.StreamHandler()],
+    format="%(message)s",
+    handlers=[logging.handlers.QueueHandler(_log_queue)],
 )
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# Полезная нагрузка — только repo и tag; всё крупнее отклоняется с 413 до чтения тела
+app.config["MAX_CONTENT_LENGTH"] = 64 * 1024
 
 WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "").encode()
 DEPLOY_ROOT = Path(os.environ.get("DEPLOY_ROOT", "/apps"))
 
+# owner/repo: ровно один слеш, обе части непустые, repo не "." / ".." (выход из DEPLOY_ROOT).
+# owner не начинается с точки: такие имена в DEPLOY_ROOT заняты служебными файлами
+# (.ports.db и её -wal/-shm), а у GitHub их не бывает
+_REPO_RE = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9._-]*/(?!\.{1,2}\Z)[A-Za-z0-9._-]+")
 
-def get_port_for_repo(owner: str, repo_name: str) -> int:
-    """Рассчитывает внешний порт для репозитория (стабильный через сортировку)."""
-    owners = sorted([d.name for d in DEPLOY_ROOT.iterdir() if d.is_dir()])
-    owner_index = owners.index(owner) if owner in owners else len(owners)
-    base_port = 2000 + owner_index * 1000
-
-    owner_path = DEPLOY_ROOT / owner
-    repos = (
-        sorted([d.name for d in owner_path.iterdir() if d.is_dir()])
-        if owner_path.exists()
-        else []
-    )
-    repo_index = repos.index(repo_name) if repo_name in repos else len(repos)
+if not WEBHOOK_SECRET:
+    raise RuntimeError("WEBHOOK_SECRET unset")
 
-    return base_port + repo_index + 1  # Порт начинается с 1
+# HMAC с уже обработанным ключом: copy() дешевле повторного хеширования ключа
+_HMAC_TEMPLATE = hmac.new(WEBHOOK_SECRET, b"", hashlib.sha256)
 
 
-def verify_signature(payload: bytes, sig_header: str) -> bool:
-    if not WEBHOOK_SECRET or not sig_header:
-        return False
-    expected = "sha256=" + hmac.new(WEBHOOK_SECRET, payload, hashlib.sha256).hexdigest()
-    return hmac.compare_digest(expected, sig_header)
+PORTS_DB = DEPLOY_ROOT / ".ports.db"
+BASE_PORT = 2000
+# Внешний порт в сгенерированном docker-compose.yml: - "2001:5000"
+_COMPOSE_PORT_RE = re.compile(r'"(\d+):5000"')
 
+_ports_lock = threading.Lock()
+_ports_conn: sqlite3.Connection | None = None
+_ports_cache: dict[tuple[str, str], int] = {}
 
-def ensure_compose_file(repo_path: Path, full_repo: str, tag: str) -> Path:
-    """Гарантированно создаёт/перезаписывает docker-compose.yml с актуальным тегом."""
-    owner, repo_name = full_repo.split("/", 1)
-    external_port = get_port_for_repo(owner, repo_name)
-    compose_content = f"""services:
+_COMPOSE_TMPL = """services:
   app:
     image: ghcr.io/{full_repo}:{tag}
     env_file:
@@ -56,7 +111,7 @@ def ensure_compose_file(repo_path: Path, full_repo: str, tag: str) -> Path:
     environment:
       - IN_DOCKER=1
     ports:
-      - "{external_port}:5000"
+      - "{port}:5000"
     restart: unless-stopped
     networks:
       - db-net
@@ -66,26 +121,266 @@ def ensure_compose_file(repo_path: Path, full_repo: str, tag: str) -> Path:
 networks:
   db-net:
     external: true"""
+
+# Хеш последнего записанного содержимого docker-compose.yml по пути файла
+_compose_digests: dict[Path, bytes] = {}
+
+# Один event loop в фоновом потоке ведёт все docker compose процессы
+_deploy_loop = asyncio.new_event_loop()
+threading.Thread(
+    target=_deploy_loop.run_forever, name="deploy-loop", daemon=True
+).start()
+_deploy_slots = asyncio.Semaphore(4)  # не больше 4 деплоев одновременно
+STDERR_TAIL_LINES = 50  # строк stderr docker compose в сообщении об ошибке
+STDERR_LINE_MAX = 64 * 1024  # более длинные строки stderr режутся на части
+# Последний запрошенный тег по репозиторию и репозитории, деплой которых идёт сейчас
+_deploy_lock = threading.Lock()
+_pending: dict[tuple[str, str], str] = {}
+_running: set[tuple[str, str]] = set()
+
+
+def _seed_legacy_ports(conn: sqlite3.Connection) -> None:
+    """Переносит порты уже развёрнутых репозиториев из их docker-compose.yml."""
+    for compose_file in sorted(DEPLOY_ROOT.glob("*/*/docker-compose.yml")):
+        match = _COMPOSE_PORT_RE.search(compose_file.read_text(encoding="utf-8"))
+        if match is None:
+            continue
+        owner, repo_name = compose_file.parent.parent.name, compose_file.parent.name
+        port = int(match.group(1))
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO ports (owner, repo, port) VALUES (?, ?, ?)",
+            (owner, repo_name, port),
+        )
+        if cur.rowcount == 0:
+            logger.warning(f"⚠️ Порт {port} для {owner}/{repo_name} уже занят, пропущен")
+
+
+def _get_ports_db() -> sqlite3.Connection:
+    global _ports_conn
+    if _ports_conn is None:
+        DEPLOY_ROOT.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(
+            PORTS_DB, isolation_level=None, check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS ports (
+                owner TEXT NOT NULL,
+                repo TEXT NOT NULL,
+                port INTEGER PRIMARY KEY,
+                UNIQUE (owner, repo)
+            )"""
+        )
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            if conn.execute("SELECT 1 FROM ports LIMIT 1").fetchone() is None:
+                _seed_legacy_ports(conn)
+        _ports_conn = conn
+    return _ports_conn
+
+
+# Перенос портов выполняется при старте, до того как вебхуки создадут новые каталоги
+_get_ports_db()
+
+
+def get_port_for_repo(owner: str, repo_name: str) -> int:
+    """Возвращает внешний порт репозитория, при первом обращении выделяя новый."""
+    key = (owner, repo_name)
+    port = _ports_cache.get(key)
+    if port is not None:
+        return port
+
+    with _ports_lock:
+        conn = _get_ports_db()
+        # BEGIN IMMEDIATE сериализует выделение портов между процессами
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            row = conn.execute(
+                "SELECT port FROM ports WHERE owner = ? AND repo = ?", key
+            ).fetchone()
+            if row is None:
+                (port,) = conn.execute(
+                    "SELECT COALESCE(MAX(port), ?) + 1 FROM ports", (BASE_PORT,)
+                ).fetchone()
+                conn.execute(
+                    "INSERT INTO ports (owner, repo, port) VALUES (?, ?, ?)",
+                    (owner, repo_name, port),
+                )
+                logger.info(f"🔌 Выделен порт {port} для {owner}/{repo_name}")
+            else:
+                (port,) = row
+        _ports_cache[key] = port
+    return port
+
+
+def verify_signature(payload: bytes, sig_header: bytes) -> bool:
+    if not sig_header.startswith(b"sha256="):
+        return False
+    try:
+        provided = binascii.unhexlify(sig_header[7:])
+    except (binascii.Error, ValueError):
+        return False
+    mac = _HMAC_TEMPLATE.copy()
+    mac.update(payload)
+    return hmac.compare_digest(mac.digest(), provided)
+
+
+def ensure_compose_file(repo_path: Path, full_repo: str, tag: str) -> Path:
+    """Гарантированно создаёт docker-compose.yml с актуальным тегом (пишет только при изменениях)."""
+    owner, repo_name = full_repo.split("/", 1)
+    external_port = get_port_for_repo(owner, repo_name)
+    compose_content = _COMPOSE_TMPL.format_map(
+        {"full_repo": full_repo, "tag": tag, "port": external_port}
+    )
     compose_file = repo_path / "docker-compose.yml"
-    compose_file.write_text(compose_content, encoding="utf-8")
+    new = compose_content.encode("utf-8")
+    digest = hashlib.blake2b(new, digest_size=16).digest()
+    if _compose_digests.get(compose_file) == digest and compose_file.exists():
+        return compose_file
+
+    # Атомарная замена: параллельный docker compose не увидит полузаписанный файл
+    tmp = compose_file.with_suffix(".yml.tmp")
+    tmp.write_bytes(new)
+    os.replace(tmp, compose_file)
+    _compose_digests[compose_file] = digest
     logger.info(
         f"✅ docker-compose.yml обновлён для {full_repo} (тег: {tag}, порт: {external_port})"
     )
     return compose_file
 
 
+async def _drain_stderr(
+    proc: asyncio.subprocess.Process, full_repo: str, tail: deque[str]
+) -> None:
+    """Пишет stderr процесса в лог построчно и дожидается его завершения."""
+    assert proc.stderr is not None
+
+    def emit(raw: bytes) -> None:
+        line = raw.decode(errors="replace").rstrip()
+        tail.append(line)
+        logger.info(f"[{full_repo}] {line}")
+
+    # Чтение блоками вместо readline(): строка длиннее лимита StreamReader
+    # не роняет чтение, а выводится частями по STDERR_LINE_MAX байт
+    buf = b""
+    while chunk := await proc.stderr.read(STDERR_LINE_MAX):
+        *lines, buf = (buf + chunk).split(b"\n")
+        for raw in lines:
+            emit(raw)
+        while len(buf) >= STDERR_LINE_MAX:
+            emit(buf[:STDERR_LINE_MAX])
+            buf = buf[STDERR_LINE_MAX:]
+    if buf:
+        emit(buf)
+    await proc.wait()
+
+
+async def _deploy(repo_path: Path, full_repo: str, tag: str) -> None:
+    """Обновляет docker-compose.yml и выполняет docker compose up с pull."""
+    owner, repo_name = full_repo.split("/", 1)
+    # === Генерация docker-compose.yml с актуальным тегом ===
+    # sqlite и запись файла блокируют, поэтому не в deploy-loop
+    try:
+        compose_file = await asyncio.to_thread(
+            ensure_compose_file, repo_path, full_repo, tag
+        )
+    except Exception as e:
+        logger.exception(f"💥 Ошибка создания docker-compose.yml: {e}")
+        return
+
+    # === Выполнение docker compose команд ===
+    try:
+        logger.info(f"🔄 Запуск деплоя {full_repo}:{tag} в {repo_path}")
+
+        # Pull и up одним вызовом CLI: один fork/exec и один разбор compose-файла
+        up = await asyncio.create_subprocess_exec(
+            "docker",
+            "compose",
+            "-f",
+            str(compose_file),
+            "up",
+            "-d",
+            "--pull",
+            "always",
+            "--quiet-pull",
+            "--remove-orphans",
+            cwd=repo_path,
+            # stdout наследуется и идёт прямо в лог контейнера; stderr (прогресс compose)
+            # читается блоками и пишется в лог построчно, в памяти остаётся только хвост для сообщения об ошибке
+            stdout=None,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stderr_tail: deque[str] = deque(maxlen=STDERR_TAIL_LINES)
+        try:
+            await asyncio.wait_for(
+                _drain_stderr(up, full_repo, stderr_tail), timeout=240
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"💥 Таймаут выполнения docker compose для {full_repo}:{tag}")
+            return
+        finally:
+            # Таймаут или любая ошибка чтения: процесс не должен остаться без присмотра
+            if up.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    up.kill()
+                await up.wait()
+        if up.returncode != 0:
+            logger.error(
+                "❌ docker compose up failed:\nSTDERR: " + "\n".join(stderr_tail)
+            )
+            return
+
+        port = await asyncio.to_thread(get_port_for_repo, owner, repo_name)
+        logger.info(f"✅ Успешный деплой {full_repo}:{tag} на порту {port}")
+
+    except Exception as e:
+        logger.exception(f"💥 Критическая ошибка деплоя: {e}")
+
+
+async def _deploy_worker(repo_path: Path, full_repo: str) -> None:
+    """Деплоит последний запрошенный тег, пока приходят новые (в deploy-loop)."""
+    owner, repo_name = full_repo.split("/", 1)
+    key = (owner, repo_name)
+    while True:
+        # Тег берётся только после получения слота: пока деплой ждёт очереди,
+        # новые вебхуки продолжают заменять тег в _pending
+        async with _deploy_slots:
+            with _deploy_lock:
+                tag = _pending.pop(key, None)
+                if tag is None:
+                    _running.discard(key)
+                    return
+                _running.add(key)
+            await _deploy(repo_path, full_repo, tag)
+
+
+def schedule_deploy(repo_path: Path, full_repo: str, tag: str) -> bool:
+    """Ставит деплой в очередь; False, если он слился с уже ожидающим/идущим."""
+    owner, repo_name = full_repo.split("/", 1)
+    key = (owner, repo_name)
+    with _deploy_lock:
+        merged = key in _pending or key in _running
+        _pending[key] = tag
+        if not merged:
+            asyncio.run_coroutine_threadsafe(
+                _deploy_worker(repo_path, full_repo), _deploy_loop
+            )
+    return not merged
+
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
     # === Валидация подписи ===
-    sig = request.headers.get("X-Hub-Signature-256")
-    payload = request.get_data()
-    if not verify_signature(payload, sig):  # type: ignore
+    # Werkzeug декодирует заголовки как latin-1, обратное кодирование без потерь
+    sig = request.headers.get("X-Hub-Signature-256", "").encode("latin-1")
+    payload = request.get_data(cache=True)
+    if not verify_signature(payload, sig):
         logger.warning("❌ Неверная подпись вебхука")
         abort(403, description="Invalid signature")
 
     # === Парсинг и валидация данных ===
     try:
-        data = request.get_json()
+        data = json.loads(payload)
         if not data:
             abort(400, description="Empty payload")
         full_repo = data.get("repo", "").strip()
@@ -94,11 +389,7 @@ def webhook():
         logger.error(f"❌ Ошибка парсинга JSON: {e}")
         abort(400, description="Invalid JSON")
 
-    if (
-        not full_repo
-        or full_repo.count("/") != 1
-        or not all(c.isalnum() or c in "-_./" for c in full_repo)
-    ):
+    if not _REPO_RE.fullmatch(full_repo):
         logger.error(f"❌ Некорректный формат репозитория: {full_repo}")
         abort(400, description="Invalid repo format")
     if not tag:
@@ -109,75 +400,26 @@ def webhook():
     repo_path = DEPLOY_ROOT / owner / repo_name
     repo_path.mkdir(parents=True, exist_ok=True)
 
-    # === Генерация docker-compose.yml с актуальным тегом ===
     try:
-        compose_file = ensure_compose_file(repo_path, full_repo, tag)
+        port = get_port_for_repo(owner, repo_name)
     except Exception as e:
-        logger.exception(f"💥 Ошибка создания docker-compose.yml: {e}")
-        return jsonify(
-            {"error": "Compose file generation failed", "details": str(e)}
-        ), 500
+        logger.exception(f"💥 Ошибка выделения порта: {e}")
+        return jsonify({"error": "Port allocation failed", "details": str(e)}), 500
 
-    # === Выполнение docker compose команд ===
-    try:
-        logger.info(f"🔄 Запуск деплоя {full_repo}:{tag} в {repo_path}")
+    # === Деплой в фоне, чтобы не держать запрос GitHub ===
+    if schedule_deploy(repo_path, full_repo, tag):
+        logger.info(f"📥 Деплой {full_repo}:{tag} поставлен в очередь")
+        message = "Deployment queued"
+    else:
+        logger.info(f"📥 Деплой {full_repo}:{tag} объединён с текущим")
+        message = "Coalesced with in-flight deployment"
+    return jsonify(
+        {
+            "status": "queued",
+            "repo": full_repo,
+            "tag": tag,
+            "port": port,
+            "message": message,
+        }
+    ), 202
 
-        # Pull с явным указанием файла (надёжнее)
-        pull = subprocess.run(
-            ["docker", "compose", "-f", str(compose_file), "pull"],
-            cwd=repo_path,
-            capture_output=True,
-            text=True,
-            timeout=120,
-        )
-        if pull.returncode != 0:
-            logger.error(
-                f"❌ docker compose pull failed:\nSTDOUT: {pull.stdout}\nSTDERR: {pull.stderr}"
-            )
-            return jsonify(
-                {"error": "Pull failed", "stdout": pull.stdout, "stderr": pull.stderr}
-            ), 500
-
-        # Up
-        up = subprocess.run(
-            [
-                "docker",
-                "compose",
-                "-f",
-                str(compose_file),
-                "up",
-                "-d",
-                "--remove-orphans",
-            ],
-            cwd=repo_path,
-            capture_output=True,
-            text=True,
-            timeout=120,
-        )
-        if up.returncode != 0:
-            logger.error(
-                f"❌ docker compose up failed:\nSTDOUT: {up.stdout}\nSTDERR: {up.stderr}"
-            )
-            return jsonify(
-                {"error": "Deploy failed", "stdout": up.stdout, "stderr": up.stderr}
-            ), 500
-
-        logger.info(
-            f"✅ Успешный деплой {full_repo}:{tag} на порту {get_port_for_repo(owner, repo_name)}"
-        )
-        return jsonify(
-            {
-                "status": "success",
-                "repo": full_repo,
-                "tag": tag,
-                "port": get_port_for_repo(owner, repo_name),
-                "message": "Deployed successfully",
-            }
-        ), 200
-
-    except subprocess.TimeoutExpired:
-        logger.exception("💥 Таймаут выполнения docker compose")
-        return jsonify({"error": "Deployment timeout"}), 500
-    except Exception as e:
-        logger.exception(f"💥 Критическая ошибка деплоя: {e}")
-        return jsonify({"error": "Internal server error", "details": str(e)}), 500